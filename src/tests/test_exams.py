@@ -0,0 +1,55 @@
+from unittest import TestCase
+from ..worker import parse_exams
+
+
+RESULT_DETAILS = """
+<html>
+<head><script>var popup = true;</script></head>
+<body>
+<div>
+<form>
+<table>
+<tbody>
+<tr><td class="level01" colspan="6">Versuch 2</td></tr>
+<tr><td class="tbsubhead">Semester</td><td class="tbsubhead">Prüfung</td><td class="tbsubhead">Datum</td><td class="tbsubhead">Bewertung</td><td class="tbsubhead"></td><td class="tbsubhead"></td></tr>
+<tr>
+<td class="tbdata">SoSe&nbsp;2021</td>
+<td class="tbdata">Klausur<br>(100%)<script>document.write("x");</script><span style="display: none">hidden</span></td>
+<td class="tbdata">
+    15.07.2021
+</td>
+<td class="tbdata">&nbsp;1,7&nbsp;</td>
+<td class="tbdata"></td>
+<td class="tbdata"></td>
+</tr>
+</tbody>
+</table>
+<table>
+<tbody>
+<tr><td class="tbdata">WiSe 2020</td><td class="tbdata">Ignored</td><td class="tbdata"></td><td class="tbdata">4,0</td><td class="tbdata"></td><td class="tbdata"></td></tr>
+</tbody>
+</table>
+</form>
+</div>
+</body>
+</html>
+"""
+
+
+class TestParseExams(TestCase):
+    def setUp(self):
+        self.exams = parse_exams(RESULT_DETAILS)
+
+    def test_only_data_rows_of_first_table(self):
+        self.assertEqual(len(self.exams), 1)
+
+    def test_exam_fields(self):
+        exam = self.exams[0]
+        self.assertEqual(exam.Attempt, 2)
+        self.assertEqual(exam.Semester, "SoSe 2021")
+        self.assertEqual(exam.ExamType, "Klausur\n(100%)")
+        self.assertEqual(exam.Date, "15.07.2021")
+        self.assertEqual(exam.Grade, 1.7)
+
+    def test_no_rows(self):
+        self.assertEqual(parse_exams("<html><body><div><form></form></div></body></html>"), [])
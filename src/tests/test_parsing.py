@@ -0,0 +1,50 @@
+from unittest import TestCase
+from ..worker import get_int, get_float
+
+
+class TestGetInt(TestCase):
+    def test_empty(self):
+        self.assertEqual(get_int(""), -1)
+
+    def test_dash(self):
+        self.assertEqual(get_int("-"), -1)
+
+    def test_int(self):
+        self.assertEqual(get_int("3"), 3)
+
+    def test_negative(self):
+        self.assertEqual(get_int("-2"), -2)
+
+    def test_padded(self):
+        self.assertEqual(get_int(" 3 "), 3)
+
+    def test_decimal(self):
+        self.assertEqual(get_int("1,3"), -1)
+        self.assertEqual(get_int("1.3"), -1)
+
+
+class TestGetFloat(TestCase):
+    def test_empty(self):
+        self.assertEqual(get_float(""), -1)
+
+    def test_dash(self):
+        self.assertEqual(get_float("-"), -1)
+
+    def test_comma(self):
+        self.assertEqual(get_float("1,3"), 1.3)
+
+    def test_dot(self):
+        self.assertEqual(get_float("1.3"), 1.3)
+
+    def test_int(self):
+        self.assertEqual(get_float("5"), 5.0)
+
+    def test_negative(self):
+        self.assertEqual(get_float("-1,5"), -1.5)
+
+    def test_padded(self):
+        self.assertEqual(get_float(" 2,7 "), 2.7)
+        self.assertEqual(get_float("\t2.7\n"), 2.7)
+
+    def test_text(self):
+        self.assertEqual(get_float("noch nicht gesetzt"), -1)
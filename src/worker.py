@@ -1,24 +1,74 @@
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver import Chrome
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, WebDriverException
+from selenium.webdriver import Remote
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chromium.remote_connection import ChromiumRemoteConnection
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.remote.webelement import WebElement
+from selenium.webdriver.support.ui import Select, WebDriverWait
+from lxml.etree import XPath
+from lxml.html import document_fromstring
 from argparse import ArgumentParser
 from .models import Exam, Course
-from typing import List
+from typing import List, Tuple
 from .models.course import CourseCompletion
 from logging import basicConfig, info, exception, error, INFO, WARN
 from datetime import datetime
-from time import sleep
 from enum import Enum
-from json import dumps
+from json import dump, dumps, load
 from sys import stderr
-from os import makedirs
-from os.path import isdir
+from os import makedirs, fdopen, remove, replace
+from os.path import abspath, dirname, isdir, isfile
+from tempfile import mkstemp
 from base64 import b64decode
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+from re import compile as re_compile
+from hashlib import sha256
 
 
 UNAME_VAR_NAME = "uname"
 PWD_VAR_NAME = "pwd"
+MAX_WORKERS = 4
+INT_PATTERN = re_compile(r"\s*-?\d+\s*")
+FLOAT_PATTERN = re_compile(r"\s*-?\d+(?:[.,]\d+)?\s*")
+BLOCKED_URLS = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.ico", "*.svg", "*.woff", "*.woff2", "*.ttf", "*google-analytics*"]
+COMPLETION_MAP = {
+    "": CourseCompletion.Unknown,
+    "bestanden": CourseCompletion.Passed
+}
+
+USER_FIELD = (By.ID, "field_user")
+LOGIN_BUTTON = (By.ID, "logIn_btn")
+LOGIN_HEADING = (By.CSS_SELECTOR, "body > div:nth-of-type(3) > div:nth-of-type(3) > div:nth-of-type(2) > div:nth-of-type(2) > h1")
+RESULTS_LINK = (By.ID, "link000307")
+SEMESTER_SELECT = (By.ID, "semester")
+SEMESTER_OPTIONS = (By.TAG_NAME, "option")
+COURSE_ROWS = (By.CSS_SELECTOR, "body > div:nth-of-type(3) > div:nth-of-type(3) > div:nth-of-type(2) > div:nth-of-type(2) > div > table > tbody > tr")
+COURSES_SCRIPT = """
+return Array.from(document.querySelectorAll(arguments[0])).slice(0, -1).map(row => {
+    const cells = row.getElementsByTagName('td');
+    const link = cells.length > 5 ? cells[5].querySelector('a[href]') : null;
+    const href = link !== null ? link.getAttribute('href') : '';
+    const url = href !== '' && !href.startsWith('#') && !href.startsWith('javascript:') ? link.href : null;
+    return [Array.from(cells).slice(0, 5).map(x => x.innerText.trim()), url, cells[5]];
+});
+"""
+CREDENTIALS_SCRIPT = """
+const fields = [[document.getElementById('field_user'), arguments[0]], [document.getElementById('field_pass'), arguments[1]]];
+if (fields.some(([field, value]) => field === null)) {
+    return false;
+}
+for (const [field, value] of fields) {
+    field.value = value;
+    field.dispatchEvent(new Event('input', {bubbles: true}));
+}
+return true;
+"""
+EXAM_ROWS = XPath("/html/body/div/form/table[1]/tbody/tr")
+HIDDEN_ELEMENTS = XPath("//script | //style | //noscript | //*[@hidden] | //*[contains(translate(@style, ' ', ''), 'display:none')]")
+LINE_BREAKS = XPath("//br | //div | //p")
 
 
 class STATUSCODE(Enum):
@@ -48,8 +98,11 @@ def get_parser() -> ArgumentParser:
     parser.add_argument("--windowTries", type=int, default=3, help="How many times you'd like for the scanner to retry opening a window.")
     parser.add_argument("--windowCheckWait", type=float, default=1, help="Amount of seconds the scanner should wait until trying to a open window again.")
     parser.add_argument("--url", type=str, default="https://dualis.dhbw.de/", help="The dualis url to open.")
-    parser.add_argument("--implicitWait", type=float, default=0.1, help="How long the driver should wait for contents to appear.")
+    parser.add_argument("--implicitWait", type=float, default=0, help="Deprecated and ignored, the scanner only uses explicit waits.")
+    parser.add_argument("--waitTimeout", type=float, default=10, help="Maximum amount of seconds the scanner should wait for a page to be ready.")
     parser.add_argument("--base64", action="store_true", help="Set if you want to pass the credentials as base64-encrypted strings.")
+    parser.add_argument("--cookieCache", type=str, help="The file in which the login session is cached between runs.")
+    parser.add_argument("--workers", type=int, default=1, help=f"How many browser sessions should scan semesters in parallel (at most {MAX_WORKERS}).")
     return parser
 
 
@@ -79,161 +132,392 @@ def main():
         data = get_courses(args)
         if not args.dry:
             print(dumps([x.toDict() for x in data]))
-    except NoSuchElementException as nse:
-        exception(nse)
+    except (NoSuchElementException, TimeoutException) as ex:
+        exception(ex)
         doErrorExit(STATUSCODE.CRASH)
 
     exit(STATUSCODE.OK.value)
 
 
 def get_int(string: str) -> int:
-    val = -1
-    try:
-        val = int(string)
-    except ValueError:
-        pass
-    return val
+    if INT_PATTERN.fullmatch(string) is None:
+        return -1
+    return int(string)
 
 
 def get_float(string: str) -> float:
-    grade = -1
-    try:
-        grade = float(string.replace(',', '.'))
-    except ValueError:
-        pass
-    return grade
+    if FLOAT_PATTERN.fullmatch(string) is None:
+        return -1
+    return float(string.replace(',', '.'))
 
 
-def get_courses(args) -> List[Course]:
-    info("Getting courses")
-    options = Options()
-    options.headless = True
+def execute_cdp_cmd(driver: Remote, cmd: str, cmd_args: dict) -> dict:
+    return driver.execute("executeCdpCommand", {"cmd": cmd, "params": cmd_args})["value"]
 
-    driver_dir = "/usr/local/bin/chromedriver"
-    if args.driver is not None:
-        driver_dir = args.driver
-    info(f"Using driverdir: {driver_dir}")
-    driver = Chrome(executable_path=driver_dir, options=options)
-    driver.implicitly_wait(args.implicitWait)
 
-    i = 0
-    pageOpened = False
+def block_urls(driver: Remote):
+    execute_cdp_cmd(driver, "Network.enable", {})
+    execute_cdp_cmd(driver, "Network.setBlockedURLs", {"urls": BLOCKED_URLS})
+
+
+def close_windows(driver: Remote, windows: List[str]):
+    for window in windows:
+        try:
+            execute_cdp_cmd(driver, "Target.closeTarget", {"targetId": window})
+        except WebDriverException:
+            driver.switch_to.window(window)
+            driver.close()
+
+
+def get_credentials(args) -> Tuple[str, str]:
     uname = args.uname[0]
-    if args.base64:
-        uname = b64decode(uname).decode("utf-8")
     pwd = args.pwd[0]
     if args.base64:
-        pwd = b64decode(pwd).decode("utf-8")
-    while i < args.windowTries:
-        info(f"Starting attempt {i} of opening the main page.")
+        try:
+            uname = b64decode(uname).decode("utf-8")
+            pwd = b64decode(pwd).decode("utf-8")
+        except ValueError:
+            error("Credentials are not valid base64-encoded utf-8 strings.")
+            doErrorExit(STATUSCODE.INVALID_LOGIN)
+
+    if uname.strip() == "" or pwd == "":
+        error("Username or password is empty.")
+        doErrorExit(STATUSCODE.INVALID_LOGIN)
+    return uname, pwd
+
+
+def document_parsed(driver: Remote) -> bool:
+    return driver.execute_script("return document.readyState") != "loading"
+
+
+def create_driver(args, server_url: str) -> Remote:
+    options = Options()
+    options.headless = True
+    options.page_load_strategy = "eager"
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    options.add_argument("--disable-extensions")
+    options.add_argument("--disable-background-networking")
+    options.add_argument("--disable-sync")
+    options.add_argument("--disable-default-apps")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+
+    driver = Remote(command_executor=ChromiumRemoteConnection(server_url, "goog", "chrome"), options=options)
+    driver.implicitly_wait(0)
+    driver.set_page_load_timeout(args.waitTimeout)
+    block_urls(driver)
+    return driver
+
+
+def get_user_hash(uname: str) -> str:
+    return sha256(uname.encode("utf-8")).hexdigest()
+
+
+def restore_session(driver: Remote, args, uname: str) -> bool:
+    if args.cookieCache is None or not isfile(args.cookieCache):
+        return False
+
+    info("Restoring cached session.")
+    try:
+        with open(args.cookieCache) as session_file:
+            session = load(session_file)
+        if session["user"] != get_user_hash(uname):
+            info("Cached session belongs to a different user.")
+            return False
+
         driver.get(args.url)
-        sleep(args.windowCheckWait)
+        for cookie in session["cookies"]:
+            driver.add_cookie(cookie)
+        driver.get(session["url"])
+        page_element = WebDriverWait(driver, args.waitTimeout).until(EC.any_of(
+            EC.presence_of_element_located(SEMESTER_SELECT),
+            EC.presence_of_element_located(USER_FIELD),
+            EC.presence_of_element_located(LOGIN_HEADING)
+        ))
+        if page_element.get_attribute("id") != SEMESTER_SELECT[1] and len(driver.find_elements(*SEMESTER_SELECT)) == 0:
+            info("Cached session has expired.")
+            return False
+    except (ValueError, KeyError, TypeError, WebDriverException):
+        info("Cached session is invalid or expired.")
+        return False
+
+    info("Restored cached session.")
+    return True
+
+
+def save_session(driver: Remote, args, uname: str):
+    session = {
+        "user": get_user_hash(uname),
+        "url": driver.current_url,
+        "cookies": driver.get_cookies()
+    }
+    session_path = None
+    try:
+        session_fd, session_path = mkstemp(dir=dirname(abspath(args.cookieCache)))
+        with fdopen(session_fd, "w") as session_file:
+            dump(session, session_file)
+        replace(session_path, args.cookieCache)
+    except (OSError, TypeError) as ex:
+        error(f"Could not write the session cache: {ex}")
+        if session_path is not None and isfile(session_path):
+            remove(session_path)
+
 
+def login(driver: Remote, args, uname: str, pwd: str) -> int:
+    if restore_session(driver, args, uname):
+        return 0
+
+    i = 0
+    pageOpened = False
+    reloadPage = True
+    while i < args.windowTries:
         try:
-            driver.find_element(By.ID, "field_user").send_keys(uname)
+            if reloadPage:
+                info(f"Starting attempt {i} of opening the main page.")
+                driver.get(args.url)
+            else:
+                info(f"Starting attempt {i} of waiting for the main page to finish loading.")
+
+            WebDriverWait(driver, args.windowCheckWait).until(EC.presence_of_element_located(USER_FIELD))
             pageOpened = True
             break
-        except NoSuchElementException:
-            pass
+        except TimeoutException:
+            reloadPage = not reloadPage
 
         i += 1
-    retries = i
-    failures = 0
 
     if not pageOpened:
         msg = f"Dualis main page didn't open in {args.windowCheckWait} seconds during {args.windowTries} attempts."
         error(msg)
         doErrorExit(STATUSCODE.CRASH, msg)
 
-    driver.find_element(By.ID, "field_pass").send_keys(pwd)
-    driver.find_element(By.ID, "logIn_btn").click()
+    if not driver.execute_script(CREDENTIALS_SCRIPT, uname, pwd):
+        msg = "Dualis login form is missing the username or password field."
+        error(msg)
+        doErrorExit(STATUSCODE.CRASH, msg)
+    WebDriverWait(driver, args.waitTimeout).until(EC.element_to_be_clickable(LOGIN_BUTTON)).click()
 
-    try:
-        if driver.find_element(By.XPATH, "/html/body/div[3]/div[3]/div[2]/div[2]/h1").text == "Benutzername oder Passwort falsch":
+    wait = WebDriverWait(driver, args.waitTimeout)
+    landing_element = wait.until(EC.any_of(EC.visibility_of_element_located(LOGIN_HEADING), EC.element_to_be_clickable(RESULTS_LINK)))
+    if landing_element.tag_name == "h1":
+        if landing_element.text == "Benutzername oder Passwort falsch":
             error("Login failed.")
             doErrorExit(STATUSCODE.INVALID_LOGIN)
-    except NoSuchElementException:
-        pass
+        landing_element = wait.until(EC.element_to_be_clickable(RESULTS_LINK))
 
     info("Logged in.")
-    driver.find_element(By.ID, "link000307").click()
-    main_window = driver.window_handles[0]
+    landing_element.click()
+    return i
+
+
+def get_semester_select(driver: Remote, args) -> WebElement:
+    return WebDriverWait(driver, args.waitTimeout).until(EC.presence_of_element_located(SEMESTER_SELECT))
+
+
+def get_semesters(semester_select: WebElement) -> List[Tuple[str, str]]:
+    return [(x.get_attribute("value"), x.text) for x in semester_select.find_elements(*SEMESTER_OPTIONS)]
+
+
+def select_semester(driver: Remote, args, semester_select: WebElement, semester: Tuple[str, str]) -> WebElement:
+    semester_value, semester_name = semester
+    info(f"Selecting semester {semester_name}.")
+    if semester_select.get_attribute("value") == semester_value:
+        return semester_select
 
+    Select(semester_select).select_by_value(semester_value)
+    WebDriverWait(driver, args.waitTimeout).until(EC.staleness_of(semester_select))
+    return get_semester_select(driver, args)
+
+
+def get_text(element) -> str:
+    lines = element.text_content().replace("\xa0", " ").split("\n")
+    return "\n".join(x for x in (" ".join(line.split()) for line in lines) if x != "")
+
+
+def parse_exams(html: str) -> List[Exam]:
+    document = document_fromstring(html)
+    for element in HIDDEN_ELEMENTS(document):
+        element.drop_tree()
+    for element in LINE_BREAKS(document):
+        element.tail = "\n" + (element.tail or "")
+
+    exams = list()
+    attempt = -1
+    for exam in EXAM_ROWS(document):
+        exam_elements = list(exam.iter("td"))
+        exam_data = [get_text(x) for x in exam_elements]
+        exam_data_len = len(exam_data)
+
+        if exam_data_len == 6 and "tbdata" in exam_elements[0].get("class", ""):
+            exams.append(Exam(attempt, exam_data[0], exam_data[1], exam_data[2], get_float(exam_data[3])))
+            continue
+
+        if exam_data_len > 0 and exam_data[0].startswith("Versuch"):
+            attempt = get_int(exam_data[0][8:])
+    return exams
+
+
+def scan_semester(driver: Remote, args) -> Tuple[List[Course], int, int]:
+    main_window = driver.current_window_handle
     courses = list()
-    semester_len = len(driver.find_element(By.ID, "semester").find_elements(By.TAG_NAME, "option"))
-
-    for semester_idx in range(semester_len):
-        semester = driver.find_element(By.ID, "semester").find_elements(By.TAG_NAME, "option")[semester_idx]
-        info(f"Selecting semester {semester.text}.")
-        semester.click()
-
-        for course in driver.find_elements(By.XPATH, "/html/body/div[3]/div[3]/div[2]/div[2]/div/table/tbody/tr")[:-1]:
-            course_data = course.find_elements(By.TAG_NAME, "td")
-            completion = CourseCompletion.Unknown
-            if course_data[4].text.strip() != "":
-                if course_data[4].text.strip() == "bestanden":
-                    completion = CourseCompletion.Passed
-                else:
-                    completion = CourseCompletion.Failed
-            course = Course(course_data[0].text.strip(), course_data[1].text.strip(), get_float(course_data[2].text), get_float(course_data[3].text), completion, [])
-            info(f"Parsing course {course_data[0].text}")
+    linked_courses = list()
+    retries = 0
+    failures = 0
+
+    WebDriverWait(driver, args.waitTimeout).until(EC.presence_of_element_located(COURSE_ROWS))
+    for course_data, details_url, details_cell in driver.execute_script(COURSES_SCRIPT, COURSE_ROWS[1]):
+        course_id, course_name, course_grade, course_credits, course_completion = course_data
+        completion = COMPLETION_MAP.get(course_completion, CourseCompletion.Failed)
+        course = Course(course_id, course_name, get_float(course_grade), get_float(course_credits), completion, [])
+        info(f"Parsing course {course_id}")
 
+        if details_url is not None:
+            linked_courses.append((course, details_url))
+            courses.append(course)
+            continue
+
+        i = 0
+        windowOpened = False
+        while i < args.windowTries:
+            info(f"Starting attempt {i} on opening window for course {course.ID}.")
+            details_cell.click()
+
+            i += 1
+            try:
+                WebDriverWait(driver, args.windowCheckWait).until(EC.number_of_windows_to_be(2))
+                windowOpened = True
+                break
+            except TimeoutException:
+                pass
+
+        retries += i
+
+        if not windowOpened:
+            error(f"Window for course {course.ID} did not open after {args.windowCheckWait} seconds over {args.windowTries} attempts.")
+            failures += 1
+            continue
+
+        driver.switch_to.window(driver.window_handles[1])
+        block_urls(driver)
+        WebDriverWait(driver, args.waitTimeout).until(document_parsed)
+
+        info("Parsing exams.")
+        course.Exams = parse_exams(driver.page_source)
+        courses.append(course)
+
+        info("Finished course. Closing window.")
+        driver.close()
+        driver.switch_to.window(main_window)
+        stray_windows = [x for x in driver.window_handles if x != main_window]
+        if len(stray_windows) > 0:
+            info(f"Too many open windows ({len(stray_windows) + 2}). Fixing.")
+            close_windows(driver, stray_windows)
+            driver.switch_to.window(main_window)
+            WebDriverWait(driver, args.waitTimeout).until(EC.number_of_windows_to_be(1))
+
+    if len(linked_courses) > 0:
+        info(f"Opening details tab for {len(linked_courses)} courses.")
+        driver.switch_to.new_window("tab")
+        block_urls(driver)
+        for course, details_url in linked_courses:
             i = 0
-            while i < args.windowTries and len(driver.window_handles) == 1:
-                info(f"Starting attempt {i} on opening window for course {course.ID}.")
-                course_data[5].click()
-                sleep(args.windowCheckWait)
+            pageOpened = False
+            while i < args.windowTries:
+                info(f"Starting attempt {i} on opening details of course {course.ID}.")
 
                 i += 1
-                if len(driver.window_handles) != 1:
+                try:
+                    driver.get(details_url)
+                    pageOpened = True
                     break
+                except WebDriverException:
+                    pass
 
             retries += i
 
-            if len(driver.window_handles) == 1:
-                error(f"Window for course {course.ID} did not open after {args.WindowCheckWait} seconds over {args.windowTries} attempts.")
+            if not pageOpened:
+                error(f"Details of course {course.ID} did not open after {args.waitTimeout} seconds over {args.windowTries} attempts.")
                 failures += 1
+                courses.remove(course)
                 continue
 
-            driver.switch_to.window(driver.window_handles[1])
+            info(f"Parsing exams of course {course.ID}.")
+            course.Exams = parse_exams(driver.page_source)
+        driver.close()
+        driver.switch_to.window(main_window)
 
-            info("Parsing exams.")
-            exams = list()
-            attempt = -1
-            for exam in driver.find_elements(By.XPATH, "/html/body/div/form/table[1]/tbody/tr"):
-                exam_elements = exam.find_elements(By.TAG_NAME, "td")
-                exam_data = [x.text.strip() for x in exam_elements]
-                exam_data_len = len(exam_data)
+    return courses, retries, failures
 
-                if exam_data_len == 6 and "tbdata" in exam_elements[0].get_attribute("class"):
-                    exams.append(Exam(attempt, exam_data[0], exam_data[1], exam_data[2], get_float(exam_data[3])))
-                    continue
 
-                if exam_data_len > 0 and exam_data[0].startswith("Versuch"):
-                    attempt = get_int(exam_data[0][8:])
+def scan_semesters(driver: Remote, args, semester_select: WebElement, semesters: List[Tuple[str, str]]) -> List[Tuple[List[Course], int, int]]:
+    results = list()
+    for semester in semesters:
+        semester_select = select_semester(driver, args, semester_select, semester)
+        results.append(scan_semester(driver, args))
+    return results
 
-            course.Exams = exams
-            courses.append(course)
 
-            info("Finished course. Closing window.")
-            if len(driver.window_handles) > 2:
-                info(f"Too many open windows ({len(driver.window_handles)}). Fixing.")
-                for window in driver.window_handles:
-                    if window == main_window:
-                        continue
-                    driver.switch_to.window(window)
-                    driver.close()
+def scan_semesters_job(args, server_url: str, uname: str, pwd: str, semesters: List[Tuple[str, str]]) -> Tuple[List[Tuple[List[Course], int, int]], int]:
+    driver = create_driver(args, server_url)
+    try:
+        retries = login(driver, args, uname, pwd)
+        return scan_semesters(driver, args, get_semester_select(driver, args), semesters), retries
+    finally:
+        driver.quit()
+
+
+def get_courses(args) -> List[Course]:
+    info("Getting courses")
+    uname, pwd = get_credentials(args)
+
+    driver_dir = "/usr/local/bin/chromedriver"
+    if args.driver is not None:
+        driver_dir = args.driver
+    info(f"Using driverdir: {driver_dir}")
+    service = Service(executable_path=driver_dir)
+    service.start()
+
+    try:
+        driver = create_driver(args, service.service_url)
+        try:
+            retries = login(driver, args, uname, pwd)
+            semester_select = get_semester_select(driver, args)
+            if args.cookieCache is not None:
+                save_session(driver, args, uname)
+            semesters = get_semesters(semester_select)
+
+            workers = min(args.workers, MAX_WORKERS, len(semesters))
+            if workers > 1:
+                info(f"Scanning {len(semesters)} semesters with {workers} browser sessions.")
+                remaining_semesters = semesters[1:]
+                chunk_size = ceil(len(remaining_semesters) / (workers - 1))
+                chunks = [remaining_semesters[x:x + chunk_size] for x in range(0, len(remaining_semesters), chunk_size)]
+                with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+                    futures = [executor.submit(scan_semesters_job, args, service.service_url, uname, pwd, x) for x in chunks]
+                    results = scan_semesters(driver, args, semester_select, semesters[:1])
+                    for future in futures:
+                        chunk_results, chunk_retries = future.result()
+                        results += chunk_results
+                        retries += chunk_retries
             else:
-                driver.close()
-            driver.switch_to.window(main_window)
+                results = scan_semesters(driver, args, semester_select, semesters)
+        finally:
+            info("Shutting down driver.")
+            driver.quit()
+    finally:
+        service.stop()
 
-    info("Successfully parsed all exams. Shutting down driver.")
+    courses = list()
+    failures = 0
+    for semester_courses, semester_retries, semester_failures in results:
+        courses += semester_courses
+        retries += semester_retries
+        failures += semester_failures
+
+    info("Successfully parsed all exams.")
     info(f"Retries: {retries}")
     info(f"Failures: {failures}")
 
-    driver.close()
-    driver.quit()
-
     return courses
 
 